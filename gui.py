@@ -1,28 +1,69 @@
 # -*- encoding: utf-8 -*-
 import os
+import codecs
+import collections
 import sys
+import signal
 import subprocess
 import threading
 import locale
-import re
+import time
 import tkinter as tk
 from tkinter import scrolledtext, messagebox, ttk
-from datetime import datetime
 
-import pystray
-from PIL import Image, ImageDraw
+# 安装了 google-re2 时使用其 DFA 引擎匹配 ANSI 序列，否则回退到标准库 re
+try:
+    import re2 as _re
+except ImportError:
+    import re as _re
+
+# 配置文件内容缓存：绝对路径 -> ((st_mtime_ns, st_size), 文本内容)
+_CONFIG_CACHE = {}
+
+
+def _read_cached(path):
+    """读取配置文件，文件未被修改时直接返回缓存内容"""
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    key = (st.st_mtime_ns, st.st_size)
+    cached = _CONFIG_CACHE.get(path)
+    if cached and cached[0] == key:
+        return cached[1]
+
+    with open(path, 'r', encoding='utf-8-sig') as f:
+        content = f.read()
+    _CONFIG_CACHE[path] = (key, content)
+    return content
+
+
+def _write_cached(path, content):
+    """写入配置文件并同步更新缓存"""
+    path = os.path.abspath(path)
+    with open(path, 'w', encoding='utf-8-sig') as f:
+        f.write(content)
+        f.flush()
+        st = os.fstat(f.fileno())
+    _CONFIG_CACHE[path] = ((st.st_mtime_ns, st.st_size), content)
 
 
 class SystemTray:
     """系统托盘管理器"""
 
+    # 已绘制的托盘图标，首次创建后复用
+    _ICON_IMAGE = None
+
     def __init__(self, gui_app):
         self.gui = gui_app
         self.icon = None
         self.running = False
 
     def create_icon_image(self):
-        """动态创建托盘图标"""
+        """动态创建托盘图标，只在首次调用时绘制"""
+        if SystemTray._ICON_IMAGE is not None:
+            return SystemTray._ICON_IMAGE
+
+        from PIL import Image, ImageDraw
+
         width = 64
         height = 64
         image = Image.new('RGB', (width, height), (70, 130, 180))
@@ -39,6 +80,7 @@ class SystemTray:
             fill=(220, 20, 60)
         )
 
+        SystemTray._ICON_IMAGE = image
         return image
 
     def on_show(self, icon=None):
@@ -57,22 +99,29 @@ class SystemTray:
             self.gui.root.withdraw()
 
     def run(self):
-        """启动托盘图标事件循环"""
-        menu = pystray.Menu(
-            pystray.MenuItem('显示主界面', self.on_show, default=True),
-            pystray.MenuItem('最小化到托盘', self.on_minimize),
-            pystray.MenuItem('退出程序', self.on_exit)
-        )
+        """启动托盘图标事件循环，失败时在主界面日志中提示"""
+        try:
+            import pystray
 
-        self.icon = pystray.Icon(
-            'LiveRecorder',
-            self.create_icon_image(),
-            '直播录制器 - 点击显示窗口',
-            menu
-        )
-        self.running = True
-        self.icon.on_activate = self.on_show
-        self.icon.run()
+            menu = pystray.Menu(
+                pystray.MenuItem('显示主界面', self.on_show, default=True),
+                pystray.MenuItem('最小化到托盘', self.on_minimize),
+                pystray.MenuItem('退出程序', self.on_exit)
+            )
+
+            self.icon = pystray.Icon(
+                'LiveRecorder',
+                self.create_icon_image(),
+                '直播录制器 - 点击显示窗口',
+                menu
+            )
+            self.running = True
+            self.icon.on_activate = self.on_show
+            self.icon.run()
+        except Exception as e:
+            self.running = False
+            self.gui.root.after(0, self.gui._log, f"系统托盘启动失败: {e}", "error")
+            self.gui.root.after(0, self.gui._update_status_bar)
 
     def stop(self):
         """停止托盘图标"""
@@ -127,8 +176,7 @@ class AdvancedSettingsWindow:
     def _load_config(self):
         """加载配置文件"""
         try:
-            with open(self.config_file, 'r', encoding='utf-8-sig') as f:
-                content = f.read()
+            content = _read_cached(self.config_file)
             self.config_text.delete(1.0, tk.END)
             self.config_text.insert(1.0, content)
         except FileNotFoundError:
@@ -144,8 +192,7 @@ class AdvancedSettingsWindow:
             if content and not content.endswith('\n'):
                 content += '\n'
 
-            with open(self.config_file, 'w', encoding='utf-8-sig') as f:
-                f.write(content)
+            _write_cached(self.config_file, content)
 
             messagebox.showinfo("成功", "配置文件已保存！")
             if self.log_callback:
@@ -158,7 +205,25 @@ class AdvancedSettingsWindow:
 class LiveRecorderGUI:
     """直播录制 GUI 主类"""
 
-    ANSI_ESCAPE_PATTERN = re.compile(r'\x1b\[[0-9;]*m')
+    ANSI_ESCAPE_PATTERN = _re.compile(rb'\x1b\[[0-9;]*m')
+    # 判断块末尾是否为未完整的 ANSI 序列时最多回看的字节数
+    ANSI_TAIL_LOOKBACK = 32
+
+    # 单次从管道读取的最大字节数
+    READ_CHUNK_SIZE = 65536
+
+    # 日志区最多保留的行数，超出后删除最早的日志
+    MAX_LINES = 5000
+    # 日志区刷新间隔（毫秒）
+    LOG_REFRESH_MS = 100
+    # 日志标签，预先构造避免每行重复创建
+    _NORMAL_TAG = ('normal',)
+    _ERROR_TAG = ('error',)
+
+    # 状态栏文本模板
+    _STATUS_RUN = "状态：运行中 (PID: {pid}) | 循环检测: 120秒 | 格式: ts → mp4 | 托盘: {tray}"
+    _STATUS_IDLE = "状态：未运行 | 循环检测: 120秒 | 格式: ts → mp4 | 托盘: {tray}"
+    _STATUS_UNSEEN = " | 新日志: {unseen} 行"
 
     def __init__(self, root):
         self.root = root
@@ -176,8 +241,19 @@ class LiveRecorderGUI:
         self.output_thread = None
         self.running = False
 
+        # 待显示日志：(文本, 标签, 秒级时间)，标签为 None 的是尚未加时间戳的子进程输出
+        self._log_buf = collections.deque(maxlen=self.MAX_LINES)
+        self._log_lock = threading.Lock()
+        self._log_dirty = False
+        self._log_unseen = 0
+        self._status_text = None
+
+        self._ts_sec = 0
+        self._ts_str = ""
+
         self.system_tray = None
         self.tray_thread = None
+        self._close_dialog = None
 
         self._setup_style()
         self._setup_ui()
@@ -261,6 +337,7 @@ class LiveRecorderGUI:
         self.log_text = scrolledtext.ScrolledText(log_frame, wrap=tk.WORD, font=("Consolas", 9),
                                                    bg="#1e1e1e", fg="#00ff00", height=10)
         self.log_text.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        self.log_text.tag_config("error", foreground="#ff5555")
 
         self.status_var = tk.StringVar()
         self.status_var.set("就绪 | 循环检测: 120秒 | 格式: ts → mp4 | 托盘: 启用")
@@ -269,16 +346,13 @@ class LiveRecorderGUI:
 
     def _load_config(self):
         """加载 URL 配置文件"""
-        config_dir = os.path.dirname(self.url_config_file)
-        os.makedirs(config_dir, exist_ok=True)
-
-        if not os.path.exists(self.url_config_file):
-            with open(self.url_config_file, 'w', encoding='utf-8-sig') as f:
-                f.write("")
-
         try:
-            with open(self.url_config_file, 'r', encoding='utf-8-sig') as f:
-                content = f.read()
+            try:
+                content = _read_cached(self.url_config_file)
+            except FileNotFoundError:
+                os.makedirs(os.path.dirname(self.url_config_file), exist_ok=True)
+                content = ""
+                _write_cached(self.url_config_file, content)
             self.config_text.delete(1.0, tk.END)
             self.config_text.insert(1.0, content)
             self._log("配置文件已加载")
@@ -292,8 +366,7 @@ class LiveRecorderGUI:
             if content and not content.endswith('\n'):
                 content += '\n'
 
-            with open(self.url_config_file, 'w', encoding='utf-8-sig') as f:
-                f.write(content)
+            _write_cached(self.url_config_file, content)
             self._log("URL 配置已保存")
             messagebox.showinfo("成功", "URL 配置已保存成功！")
         except Exception as e:
@@ -303,8 +376,7 @@ class LiveRecorderGUI:
     def open_downloads_folder(self):
         """打开下载目录"""
         downloads_path = self.downloads_dir
-        if not os.path.exists(downloads_path):
-            os.makedirs(downloads_path, exist_ok=True)
+        os.makedirs(downloads_path, exist_ok=True)
 
         try:
             if sys.platform == 'win32':
@@ -337,15 +409,19 @@ class LiveRecorderGUI:
 
             main_py = os.path.join(self.script_dir, "main.py")
 
+            popen_kwargs = {}
+            if sys.platform == 'win32':
+                popen_kwargs['creationflags'] = subprocess.CREATE_NO_WINDOW
+            else:
+                popen_kwargs['start_new_session'] = True
+
             self.process = subprocess.Popen(
                 [python_exe, main_py],
                 stdout=subprocess.PIPE,
                 stderr=subprocess.STDOUT,
-                text=True,
-                encoding=locale.getpreferredencoding(False),
-                errors='replace',
-                bufsize=1,
-                cwd=self.script_dir
+                bufsize=0,
+                cwd=self.script_dir,
+                **popen_kwargs
             )
 
             self.process_pid = self.process.pid
@@ -356,8 +432,9 @@ class LiveRecorderGUI:
             self.status_label.config(text="🟢 运行中", fg="#2e7d32")
             self._update_status_bar()
 
-            self.output_thread = threading.Thread(target=self._read_output, daemon=True)
+            self.output_thread = threading.Thread(target=self._read_output, args=(self.process,), daemon=True)
             self.output_thread.start()
+            threading.Thread(target=self._wait_process, args=(self.process, self.output_thread), daemon=True).start()
 
             self._log("=" * 50)
             self._log(f"[{self._get_timestamp()}] 录制进程已启动")
@@ -379,12 +456,20 @@ class LiveRecorderGUI:
             self._log("=" * 50)
             self._log(f"[{self._get_timestamp()}] 正在停止录制...")
 
-            self.process.terminate()
-
             try:
-                self.process.wait(timeout=3)
-            except subprocess.TimeoutExpired:
-                self.process.kill()
+                stopped = self._terminate_process()
+            except OSError as e:
+                self._log(f"请求录制进程退出失败: {e}", "error")
+                stopped = False
+
+            if stopped:
+                try:
+                    self.process.wait(timeout=3)
+                except subprocess.TimeoutExpired:
+                    stopped = False
+
+            if not stopped:
+                self._terminate_process(force=True)
                 self._log("进程已强制终止")
 
             self.running = False
@@ -404,27 +489,111 @@ class LiveRecorderGUI:
             self._log(f"停止录制失败: {e}", "error")
             messagebox.showerror("错误", f"停止录制失败: {e}")
 
-    def _read_output(self):
-        """读取子进程输出"""
-        while self.running and self.process:
+    def _terminate_process(self, force=False):
+        """结束录制进程及其启动的 ffmpeg 等子进程，返回退出请求是否被接受"""
+        if sys.platform == 'win32':
+            # 录制进程使用独立的隐藏控制台，无法向其发送 Ctrl+Break，改用 taskkill 结束整个进程树
+            cmd = ['taskkill', '/T', '/PID', str(self.process.pid)]
+            if not force:
+                result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                        creationflags=subprocess.CREATE_NO_WINDOW)
+                return result.returncode == 0
+
             try:
-                line = self.process.stdout.readline()
-                if not line:
-                    if self.process.poll() is not None:
-                        self.root.after(0, self._process_ended)
-                        break
+                subprocess.run(cmd[:1] + ['/F'] + cmd[1:], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                               creationflags=subprocess.CREATE_NO_WINDOW)
+            except OSError:
+                pass
+            self.process.kill()
+            return True
+
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL if force else signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+        return True
+
+    def _read_output(self, process):
+        """读取子进程输出，按时间窗口合并后再投递到 UI 线程，管道关闭即视为读取结束"""
+        fd = process.stdout.fileno()
+        # 增量解码器跨块保留被截断的多字节字符
+        decoder = codecs.getincrementaldecoder(locale.getpreferredencoding(False))('replace')
+        buf = bytearray()
+        # 上一块以 \r 结尾时，下一块开头的 \n 属于同一个 \r\n 换行
+        skip_lf = False
+        while self.process is process:
+            try:
+                data = os.read(fd, self.READ_CHUNK_SIZE)
+                if not data:
+                    if buf or decoder.getstate()[0]:
+                        self._queue_output(self._decode_output(bytes(buf), decoder, final=True))
+                    break
+
+                if skip_lf and data.startswith(b'\n'):
+                    data = data[1:]
+                buf += data
+                end = max(buf.rfind(b'\n'), buf.rfind(b'\r'))
+                if end < 0:
+                    # 子进程长时间不换行时按块输出，避免缓冲区无限增长
+                    if len(buf) >= self.READ_CHUNK_SIZE:
+                        cut = self._ansi_tail(buf)
+                        self._queue_output(self._decode_output(bytes(buf[:cut]), decoder))
+                        del buf[:cut]
+                    skip_lf = False
                     continue
 
-                clean_line = self.ANSI_ESCAPE_PATTERN.sub('', line.rstrip())
-                self.root.after(0, lambda l=clean_line: self._log(l))
+                skip_lf = end == len(buf) - 1 and buf[end] == 0x0d
+                if buf[end] == 0x0a and end and buf[end - 1] == 0x0d:
+                    chunk = bytes(buf[:end - 1])
+                else:
+                    chunk = bytes(buf[:end])
+                del buf[:end + 1]
+                self._queue_output(self._decode_output(chunk, decoder))
 
             except Exception as e:
-                error_msg = str(e)
-                self.root.after(0, lambda: self._log(f"读取输出错误: {error_msg}", "error"))
+                self.root.after(0, self._log, f"读取输出错误: {e}", "error")
                 break
 
-    def _process_ended(self):
+    def _wait_process(self, process, reader):
+        """等待子进程退出，待输出读取完毕后通知 UI 线程"""
+        process.wait()
+        # 子进程的子进程可能仍占用管道，最多等待 1 秒让剩余输出读完
+        reader.join(timeout=1)
+        self.root.after(0, self._process_ended, process)
+
+    def _decode_output(self, chunk, decoder, final=False):
+        """去除 ANSI 转义后一次性解码整块输出并按行拆分"""
+        chunk = self._strip_ansi(chunk)
+        text = decoder.decode(chunk, final)
+        if '\r' in text:
+            text = text.replace('\r\n', '\n').replace('\r', '\n')
+        return [line.rstrip() for line in text.split('\n')]
+
+    def _ansi_tail(self, data):
+        """返回末尾未完整 ANSI 序列的起始位置，没有时返回数据长度"""
+        esc = data.rfind(b'\x1b', max(len(data) - self.ANSI_TAIL_LOOKBACK, 0))
+        if esc < 0:
+            return len(data)
+        rest = bytes(data[esc + 1:])
+        if not rest or (rest[:1] == b'[' and not rest[1:].translate(None, b'0123456789;')):
+            return esc
+        return len(data)
+
+    def _strip_ansi(self, data):
+        """去除 ANSI 颜色序列，无转义字符时直接返回原数据"""
+        if b'\x1b' not in data:
+            return data
+        return self.ANSI_ESCAPE_PATTERN.sub(b'', data)
+
+    def _queue_output(self, lines):
+        """在读取线程中缓存子进程输出，由刷新定时器统一写入日志区"""
+        sec = int(time.time())
+        self._append_log((line, None, sec) for line in lines)
+
+    def _process_ended(self, process):
         """子进程结束回调"""
+        if process is not self.process:
+            return
         self.running = False
         self.process = None
         self.process_pid = None
@@ -444,33 +613,95 @@ class LiveRecorderGUI:
 
         if level == "error":
             display_text = f"[{timestamp}] [ERROR] {message}\n"
-            tag = "error"
+            tag = self._ERROR_TAG
         else:
             display_text = f"[{timestamp}] {message}\n"
-            tag = "normal"
+            tag = self._NORMAL_TAG
 
-        self.log_text.insert(tk.END, display_text, tag)
-        self.log_text.see(tk.END)
-        self.log_text.tag_config("error", foreground="#ff5555")
+        self._append_log(((display_text, tag, None),))
 
-    def _get_timestamp(self):
-        """获取当前时间戳"""
-        return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    def _append_log(self, entries):
+        """追加待显示的日志，并在需要时安排一次刷新（可在任意线程调用）"""
+        with self._log_lock:
+            self._log_buf.extend(entries)
+            if self._log_dirty:
+                return
+            self._log_dirty = True
+        self.root.after(self.LOG_REFRESH_MS, self._flush_log)
+
+    def _flush_log(self):
+        """将缓存的日志写入日志区；用户向上翻阅时只在状态栏提示新日志数"""
+        if self.log_text.yview()[1] < 1.0:
+            with self._log_lock:
+                self._log_unseen = len(self._log_buf)
+            self._update_status_bar()
+            self.root.after(self.LOG_REFRESH_MS, self._flush_log)
+            return
+
+        with self._log_lock:
+            entries = list(self._log_buf)
+            self._log_buf.clear()
+            self._log_dirty = False
+
+        args = []
+        run = []
+        run_tag = None
+        for text, tag, sec in entries:
+            if tag is None:
+                text = f"[{self._get_timestamp(sec)}] {text}\n"
+                tag = self._NORMAL_TAG
+            if tag != run_tag and run:
+                args += ["".join(run), run_tag]
+                run = []
+            run_tag = tag
+            run.append(text)
+        if run:
+            args += ["".join(run), run_tag]
+
+        if args:
+            self.log_text.insert(tk.END, *args)
+            self._trim_log()
+            self.log_text.see(tk.END)
+
+        if self._log_unseen:
+            self._log_unseen = 0
+            self._update_status_bar()
+
+    def _trim_log(self):
+        """仅保留最近 MAX_LINES 行日志"""
+        count = int(self.log_text.index('end-1c').split('.')[0])
+        if count > self.MAX_LINES:
+            self.log_text.delete('1.0', f'{count - self.MAX_LINES + 1}.0')
+
+    def _get_timestamp(self, sec=None):
+        """获取时间戳（默认为当前时间），同一秒内复用已格式化的字符串"""
+        if sec is None:
+            sec = int(time.time())
+        if self._ts_sec != sec:
+            self._ts_sec = sec
+            self._ts_str = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(sec))
+        return self._ts_str
 
     def _update_status_bar(self):
-        """更新状态栏"""
+        """更新状态栏，文本未变化时不触发重绘"""
         tray_status = "启用" if self.system_tray and self.system_tray.running else "未启动"
-        if self.process_pid is not None:
-            status_text = f"状态：运行中 (PID: {self.process_pid}) | 循环检测: 120秒 | 格式: ts → mp4 | 托盘: {tray_status}"
-        else:
-            status_text = f"状态：未运行 | 循环检测: 120秒 | 格式: ts → mp4 | 托盘: {tray_status}"
-        self.status_var.set(status_text)
+        template = self._STATUS_RUN if self.process_pid is not None else self._STATUS_IDLE
+        if self._log_unseen:
+            template += self._STATUS_UNSEEN
+        status_text = template.format_map({'pid': self.process_pid, 'tray': tray_status,
+                                           'unseen': self._log_unseen})
+        if status_text != self._status_text:
+            self._status_text = status_text
+            self.status_var.set(status_text)
 
     def minimize_to_tray(self):
         """最小化到托盘"""
+        if not (self.system_tray and self.system_tray.running):
+            messagebox.showwarning("警告", "系统托盘未启动，无法最小化到托盘！")
+            return
+
         self.root.withdraw()
-        if self.system_tray:
-            self.system_tray.notify('程序已最小化到系统托盘，双击托盘图标可恢复窗口')
+        self.system_tray.notify('程序已最小化到系统托盘，双击托盘图标可恢复窗口')
 
     def quit_application(self):
         """退出程序"""
@@ -489,37 +720,55 @@ class LiveRecorderGUI:
 
     def on_closing(self):
         """窗口关闭事件处理"""
-        dialog = tk.Toplevel(self.root)
-        dialog.title("关闭选项")
-        dialog.geometry("300x120")
-        dialog.resizable(False, False)
-        dialog.transient(self.root)
-        dialog.grab_set()
+        if self._close_dialog is None:
+            self._close_dialog = self._create_close_dialog()
 
+        dialog = self._close_dialog
+        dialog.deiconify()
         dialog.update_idletasks()
         x = self.root.winfo_x() + (self.root.winfo_width() - dialog.winfo_width()) // 2
         y = self.root.winfo_y() + (self.root.winfo_height() - dialog.winfo_height()) // 2
         dialog.geometry(f"+{x}+{y}")
+        dialog.lift()
+        dialog.grab_set()
+
+    def _create_close_dialog(self):
+        """创建关闭选项对话框，之后重复使用"""
+        dialog = tk.Toplevel(self.root)
+        dialog.title("关闭选项")
+        dialog.geometry("300x120")
+        dialog.resizable(False, False)
+        dialog.transient(self.root)
+        dialog.protocol("WM_DELETE_WINDOW", self._hide_close_dialog)
 
         tk.Label(dialog, text="请选择关闭方式：", font=("Arial", 11)).pack(pady=15)
 
         btn_frame = tk.Frame(dialog)
         btn_frame.pack(pady=10)
 
-        def minimize_to_tray_and_close():
-            self.minimize_to_tray()
-            dialog.destroy()
-
-        def quit_and_close():
-            dialog.destroy()
-            self.quit_application()
-
-        tk.Button(btn_frame, text="📥 最小化到托盘", command=minimize_to_tray_and_close,
+        tk.Button(btn_frame, text="📥 最小化到托盘", command=self._close_to_tray,
                   width=15, bg="#4682B4", fg="white", font=("Arial", 10)).grid(row=0, column=0, padx=5)
 
-        tk.Button(btn_frame, text="❌ 彻底退出", command=quit_and_close,
+        tk.Button(btn_frame, text="❌ 彻底退出", command=self._close_and_quit,
                   width=15, bg="#d32f2f", fg="white", font=("Arial", 10)).grid(row=0, column=1, padx=5)
 
+        return dialog
+
+    def _hide_close_dialog(self):
+        """隐藏关闭选项对话框"""
+        self._close_dialog.grab_release()
+        self._close_dialog.withdraw()
+
+    def _close_to_tray(self):
+        """关闭对话框并最小化到托盘"""
+        self._hide_close_dialog()
+        self.minimize_to_tray()
+
+    def _close_and_quit(self):
+        """关闭对话框并退出程序"""
+        self._hide_close_dialog()
+        self.quit_application()
+
 
 def main():
     """主函数"""